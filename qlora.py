@@ -1,12 +1,16 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from collections import defaultdict
-import copy
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import chain
 import json
+import math
 import os
+import shutil
 from os.path import exists, join, isdir
 from dataclasses import dataclass, field
+from functools import lru_cache
 import sys
 from typing import Optional, Dict, Sequence, List
 import numpy as np
@@ -14,17 +18,16 @@ from tqdm import tqdm
 import logging
 import bitsandbytes as bnb
 import pandas as pd
+import pyarrow as pa
 import importlib
 from packaging import version
 from packaging.version import parse
 import warnings
-from sklearn.metrics.pairwise import manhattan_distances
 from torchmetrics.functional.pairwise import pairwise_manhattan_distance as manhattan
 from torchmetrics.functional.pairwise import pairwise_cosine_similarity as cossim
 
 import torch
 import transformers
-from torch.nn.utils.rnn import pad_sequence
 import argparse
 from transformers import (
     AutoTokenizer,
@@ -34,10 +37,11 @@ from transformers import (
     Seq2SeqTrainer,
     BitsAndBytesConfig,
     LlamaTokenizer,
+    LlamaTokenizerFast,
     LlamaConfig
 
 )
-from datasets import load_dataset, Dataset, load_from_disk, DatasetDict
+from datasets import load_dataset, Dataset, load_from_disk, DatasetDict, Features
 import evaluate
 
 from peft import (
@@ -48,9 +52,10 @@ from peft import (
 )
 from peft.tuners.lora import LoraLayer
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.training_args import OptimizerNames
 
 from transformers.modeling_utils import unwrap_model
-from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
+from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING, MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
 from transformers.utils import is_peft_available
 from peft import PeftModel
 
@@ -84,6 +89,33 @@ def is_ipex_available():
     return True
     
 
+if importlib.util.find_spec("simsimd") is not None:
+    import simsimd # SIMD cosine kernels for matching samples to options on CPU
+else:
+    simsimd = None
+
+if importlib.util.find_spec("numba") is not None:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def cos_argmax(queries, options):
+        # fused argmax(queries @ options.T, axis=1) for float64 unit-length options, without the similarity matrix
+        best = np.empty(queries.shape[0], dtype=np.int64)
+        for i in prange(queries.shape[0]):
+            # seeded with option 0, since fastmath lets LLVM assume no infinities
+            best_j, best_sim = 0, 0.0
+            for k in range(queries.shape[1]):
+                best_sim += queries[i, k] * options[0, k]
+            for j in range(1, options.shape[0]):
+                sim = 0.0
+                for k in range(queries.shape[1]):
+                    sim += queries[i, k] * options[j, k]
+                best_j, best_sim = (j, sim) if sim > best_sim else (best_j, best_sim)
+            best[i] = best_j
+        return best
+else:
+    cos_argmax = None
+
 if torch.cuda.is_available():   
     torch.backends.cuda.matmul.allow_tf32 = True
 
@@ -91,6 +123,7 @@ logger = logging.getLogger(__name__)
 
 IGNORE_INDEX = -100
 DEFAULT_PAD_TOKEN = "[PAD]"
+PROMPT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mhtabby')
 
 @dataclass
 class ModelArguments:
@@ -109,6 +142,10 @@ class ModelArguments:
         default=1,
         metadata={'help': 'Number of heads (>=1) to put on the model. 1 results in normal model, more constructs multiheaded model.'}
     )
+    use_slow_tokenizer: Optional[bool] = field(
+        default=False,
+        metadata={'help': 'Use the slow (python) tokenizer instead of the fast (rust) one.'}
+    )
 
 @dataclass
 class DataArguments:
@@ -176,6 +213,10 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
         default=False,
         metadata={"help": "Whether to produce text samples at each eval."}
     )
+    wandb_log_substeps: int = field(
+        default=10,
+        metadata={"help": "Number of substeps whose per-column losses are averaged into each wandb log call."}
+    )
     full_finetune: bool = field(
         default=False,
         metadata={"help": "Finetune the entire model without adapters."}
@@ -233,7 +274,7 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
         metadata={"help": "To use wandb or something else for reporting."}
     )
     output_dir: str = field(default='./output', metadata={"help": 'The output dir for logs and checkpoints'})
-    optim: str = field(default='paged_adamw_32bit', metadata={"help": 'The optimizer to be used'})
+    optim: str = field(default='paged_adamw_32bit', metadata={"help": 'The optimizer to be used. Becomes paged_adamw_8bit with --adam8bit and 4/8 bits.'})
     per_device_train_batch_size: int = field(default=1, metadata={"help": 'The training batch size per GPU. Increase for better speed.'})
     gradient_accumulation_steps: int = field(default=16, metadata={"help": 'How many gradients to accumulate before to perform an optimizer step'})
     max_steps: int = field(default=10000, metadata={"help": 'How many optimizer update steps to take'})
@@ -248,6 +289,9 @@ class TrainingArguments(transformers.Seq2SeqTrainingArguments):
     warmup_ratio: float = field(default=0.03, metadata={"help": 'Fraction of steps to do a warmup for'})
     logging_steps: int = field(default=10, metadata={"help": 'The frequency of update steps after which to log the loss'})
     group_by_length: bool = field(default=True, metadata={"help": 'Group sequences into batches with same length. Saves memory and speeds up training considerably.'})
+    dataloader_num_workers: int = field(default=4, metadata={"help": 'Number of worker processes collating batches, so collation overlaps with the training step'})
+    dataloader_pin_memory: bool = field(default=True, metadata={"help": 'Collate into pinned memory so host to device copies can be asynchronous'})
+    dataloader_persistent_workers: bool = field(default=True, metadata={"help": 'Keep dataloader workers alive between epochs. Ignored without workers or with MMLU eval.'})
     save_strategy: str = field(default='steps', metadata={"help": 'When to save checkpoints'})
     save_steps: int = field(default=250, metadata={"help": 'How often to save a model'})
     save_total_limit: int = field(default=40, metadata={"help": 'How many checkpoints to save before the oldest is overwritten'})
@@ -292,9 +336,8 @@ def find_all_linear_names(args, model):
     cls = bnb.nn.Linear4bit if args.bits == 4 else (bnb.nn.Linear8bitLt if args.bits == 8 else torch.nn.Linear)
     lora_module_names = set()
     for name, module in model.named_modules():
-        if isinstance(module, cls):
-            names = name.split('.')
-            lora_module_names.add(names[0] if len(names) == 1 else names[-1])
+        if type(module) is cls:
+            lora_module_names.add(name.rpartition('.')[2]) # last component, or the whole name if there's no dot
         # elif 'heads.' in name:
         #     names = name.split('.')
         #     lora_module_names.add(names[-1])
@@ -334,6 +377,69 @@ class SavePeftModelCallback(transformers.TrainerCallback):
         touch(join(args.output_dir, 'completed'))
         self.save_model(args, state, kwargs)
 
+class EvalOutputSeq2SeqTrainer(Seq2SeqTrainer):
+    # keeps the last evaluation loop's output so callbacks can reuse its predictions instead of running predict again
+    _last_eval_output = None
+
+    def evaluation_loop(self, dataloader, description, prediction_loss_only=None, ignore_keys=None, metric_key_prefix="eval"):
+        if self.args.eval_samples: # evaluate() only gathers the loss without compute_metrics, but evalSampleCallback needs predictions
+            prediction_loss_only = False
+        self._last_eval_output = super().evaluation_loop(
+            dataloader, description, prediction_loss_only=prediction_loss_only,
+            ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix,
+        )
+        return self._last_eval_output
+
+def register_mhllama():
+    # the Auto* registries are process-global, so only register once
+    if MHLlamaConfig.model_type not in transformers.CONFIG_MAPPING:
+        transformers.AutoConfig.register(MHLlamaConfig.model_type, MHLlamaConfig)
+    if MHLlamaConfig not in MODEL_FOR_CAUSAL_LM_MAPPING:
+        transformers.AutoModelForCausalLM.register(MHLlamaConfig, MultiheadLlamaForCausalLM)
+
+@lru_cache(maxsize=None)
+def get_bnb_config(bits, double_quant, quant_type, compute_dtype):
+    return BitsAndBytesConfig(
+        load_in_4bit=bits == 4,
+        load_in_8bit=bits == 8,
+        llm_int8_threshold=6.0,
+        llm_int8_has_fp16_weight=False,
+        bnb_4bit_compute_dtype=compute_dtype,
+        bnb_4bit_use_double_quant=double_quant,
+        bnb_4bit_quant_type=quant_type,
+    )
+
+def load_tokenizer(tok_path, args):
+    tokenizer = AutoTokenizer.from_pretrained(
+        tok_path,
+        # cache_dir=args.cache_dir,
+        padding_side="right",
+        use_fast=not args.use_slow_tokenizer,
+        tokenizer_type='llama' if 'llama' in args.model_name_or_path else None, # Needed for HF name change
+        trust_remote_code=args.trust_remote_code,
+        # use_auth_token=args.use_auth_token,
+    )
+    if tokenizer.is_fast and hasattr(tokenizer, 'add_bos_token'):
+        tokenizer.add_bos_token = False # collators prepend BOS themselves
+    return tokenizer
+
+def check_tokenizer_parity(tokenizer, texts, args):
+    # the fast tokenizer used to give issues, so check it agrees with the slow one on the strings this run actually tokenizes
+    if not tokenizer.is_fast: return
+    slow_tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer.name_or_path,
+        use_fast=False,
+        tokenizer_type='llama' if 'llama' in args.model_name_or_path else None,
+        trust_remote_code=args.trust_remote_code,
+    )
+    # same added special tokens (pad, cls), so their strings embedded in the prompt map to the same ids
+    slow_tokenizer.add_special_tokens({k: v for k, v in tokenizer.special_tokens_map.items() if k != 'additional_special_tokens'})
+    fast_ids = tokenizer(texts, add_special_tokens=False)['input_ids']
+    slow_ids = slow_tokenizer(texts, add_special_tokens=False)['input_ids']
+    for text, fast, slow in zip(texts, fast_ids, slow_ids):
+        if fast != slow:
+            raise ValueError(f'Fast and slow tokenizers disagree on {text!r} ({fast} vs {slow}), rerun with --use_slow_tokenizer')
+
 def get_accelerate_model(args, checkpoint_dir):
 
     if torch.cuda.is_available():
@@ -358,6 +464,8 @@ def get_accelerate_model(args, checkpoint_dir):
 
     print(f'loading base model {args.model_name_or_path}...')
     compute_dtype = (torch.float16 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32))
+    # fp16 weights only for quantized runs; 16/32-bit fp16 runs load in fp32 so GradScaler never sees fp16 trainable params
+    load_dtype = torch.float16 if args.fp16 and args.bits in (4, 8) else (torch.bfloat16 if args.bf16 else torch.float32)
     
     model = None
     config = None
@@ -366,8 +474,7 @@ def get_accelerate_model(args, checkpoint_dir):
     if args.num_heads > 1:
         config = MHLlamaConfig(**vars(args))
         # model = num_headsLlamaForCausalLM(args.num_heads, config)
-        transformers.AutoConfig.register('mhllama', MHLlamaConfig)
-        transformers.AutoModelForCausalLM.register(MHLlamaConfig, MultiheadLlamaForCausalLM)
+        register_mhllama()
         # model = AutoModelForCausalLM.from_pretrained(
         #     args.model_name_or_path,
         #     config = config,
@@ -382,7 +489,7 @@ def get_accelerate_model(args, checkpoint_dir):
         #         bnb_4bit_use_double_quant=args.double_quant,
         #         bnb_4bit_quant_type=args.quant_type,
         #     ),
-        #     torch_dtype=(torch.float32 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32)),
+        #     torch_dtype=(torch.float16 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32)),
         # )
         
     model = AutoModelsDict[args.task].from_pretrained(
@@ -390,16 +497,8 @@ def get_accelerate_model(args, checkpoint_dir):
         config = config,
         device_map=device_map,
         max_memory=max_memory,
-        quantization_config=BitsAndBytesConfig(
-            load_in_4bit=args.bits == 4,
-            load_in_8bit=args.bits == 8,
-            llm_int8_threshold=6.0,
-            llm_int8_has_fp16_weight=False,
-            bnb_4bit_compute_dtype=compute_dtype,
-            bnb_4bit_use_double_quant=args.double_quant,
-            bnb_4bit_quant_type=args.quant_type,
-        ),
-        torch_dtype=(torch.float32 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32)),
+        quantization_config=get_bnb_config(args.bits, args.double_quant, args.quant_type, compute_dtype) if args.bits in (4, 8) else None,
+        torch_dtype=load_dtype,
         trust_remote_code=args.trust_remote_code,
     )
         
@@ -418,28 +517,20 @@ def get_accelerate_model(args, checkpoint_dir):
     setattr(model, 'model_parallel', True)
     setattr(model, 'is_parallelizable', True)
 
-    model.config.torch_dtype=(torch.float32 if args.fp16 else (torch.bfloat16 if args.bf16 else torch.float32))
+    model.config.torch_dtype=load_dtype
 
     # Tokenizer
     tok_path = args.model_name_or_path
     if args.num_heads > 1:
         tok_path = '/mnt/data/zoo/llama2/llama2-7b-hf/'
-    tokenizer = AutoTokenizer.from_pretrained(
-        tok_path,
-        # cache_dir=args.cache_dir,
-        padding_side="right",
-        use_fast=False, # Fast tokenizer giving issues.
-        tokenizer_type='llama' if 'llama' in args.model_name_or_path else None, # Needed for HF name change
-        trust_remote_code=args.trust_remote_code,
-        # use_auth_token=args.use_auth_token,
-    )
+    tokenizer = load_tokenizer(tok_path, args)
     if tokenizer._pad_token is None:
         smart_tokenizer_and_embedding_resize(
             special_tokens_dict=dict(pad_token=DEFAULT_PAD_TOKEN),
             tokenizer=tokenizer,
             model=model,
         )
-    if 'llama' in args.model_name_or_path or isinstance(tokenizer, LlamaTokenizer):
+    if 'llama' in args.model_name_or_path or isinstance(tokenizer, (LlamaTokenizer, LlamaTokenizerFast)):
         # LLaMA tokenizer may not have correct special tokens set.
         # Check and add them if missing to prevent them from being parsed into different tokens.
         # Note that these are present in the vocabulary.
@@ -476,16 +567,27 @@ def get_accelerate_model(args, checkpoint_dir):
             )
             model = get_peft_model(model, config)
 
+    # decide each parameter's dtype in one traversal; later (nested) modules override their parents
+    target_dtypes = {}
     for name, module in model.named_modules():
+        dtype = None
         if isinstance(module, LoraLayer):
             if args.bf16:
-                module = module.to(torch.bfloat16)
+                dtype = torch.bfloat16
         if 'norm' in name:
-            module = module.to(torch.float32)
+            dtype = torch.float32
         if 'lm_head' in name or 'embed_tokens' in name:
             if hasattr(module, 'weight'):
                 if args.bf16 and module.weight.dtype == torch.float32:
-                    module = module.to(torch.bfloat16)
+                    dtype = torch.bfloat16
+        if dtype is not None:
+            for param in module.parameters():
+                if param.is_floating_point(): # leaves quantized weights alone, like Module.to
+                    target_dtypes[param] = dtype
+    
+    for param, dtype in target_dtypes.items():
+        if param.dtype != dtype:
+            param.data = param.data.to(dtype)
 
     return model, tokenizer
 
@@ -522,11 +624,29 @@ def smart_tokenizer_and_embedding_resize(
         input_embeddings_data = model.get_input_embeddings().weight.data
         output_embeddings_data = model.get_output_embeddings().weight.data
 
-        input_embeddings_avg = input_embeddings_data[:-num_new_tokens].mean(dim=0, keepdim=True)
-        output_embeddings_avg = output_embeddings_data[:-num_new_tokens].mean(dim=0, keepdim=True)
+        # accumulate in fp32 without materializing an fp32 copy of the half-precision matrix
+        input_embeddings_avg = input_embeddings_data[:-num_new_tokens].mean(dim=0, keepdim=True, dtype=torch.float32)
+        input_embeddings_data[-num_new_tokens:] = input_embeddings_avg.to(input_embeddings_data.dtype)
+        
+        if output_embeddings_data.data_ptr() != input_embeddings_data.data_ptr(): # tied embeddings are already done
+            output_embeddings_avg = output_embeddings_data[:-num_new_tokens].mean(dim=0, keepdim=True, dtype=torch.float32)
+            output_embeddings_data[-num_new_tokens:] = output_embeddings_avg.to(output_embeddings_data.dtype)
+
+
+def _ragged_indices(lengths):
+    # (row, position) of every token when rows of the given lengths are right-padded into one 2D block
+    row_idx = np.repeat(np.arange(lengths.shape[0]), lengths)
+    col_idx = np.arange(row_idx.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return torch.from_numpy(row_idx), torch.from_numpy(col_idx)
+
 
-        input_embeddings_data[-num_new_tokens:] = input_embeddings_avg
-        output_embeddings_data[-num_new_tokens:] = output_embeddings_avg
+def _assemble_labels(prompt_flat, prompt_slots, target_slots, targets_tok):
+    # cloze rows: prompt tokens broadcast over the batch, batch_size x num_cols x max_column_len targets in their slots
+    batch_size = targets_tok.shape[0]
+    labels = targets_tok.new_empty((batch_size, prompt_slots.shape[0] + target_slots.shape[0]))
+    labels[:, prompt_slots] = prompt_flat
+    labels[:, target_slots] = targets_tok.reshape((batch_size, -1))
+    return labels
 
 
 @dataclass
@@ -548,67 +668,109 @@ class DataCollatorForMHLM:
         prompt[0] = (str(self.tokenizer.bos_token) + str(prompt[0])).strip()
         prompt[-1] = str(prompt[-1]) + str(self.tokenizer.eos_token)
         # print(prompt)
+        self.prompt = prompt
         
-        self.prompt_ids, _ = self.tokenizer(prompt,
-            add_special_tokens=False).values() 
-        self.prompt_ids = [torch.as_tensor(chunk) for chunk in self.prompt_ids] 
+        self.prompt_ids = self._tokenize_prompt(prompt)
         
         self.prompt_head_inds = [torch.zeros_like(chunk) for chunk in self.prompt_ids]
         self.prompt_head_inds[0] = self.prompt_head_inds[0][1:] # removes BOS token, accounts for model shift all to left
         # print(self.prompt_ids)
         self.col_tok = self.tokenizer(f'{self.tokenizer.cls_token}', add_special_tokens=False)['input_ids'][0] #3
         
-        self.vocab_masks = torch.as_tensor(pd.DataFrame(vocab_masks[:]).to_numpy().T, dtype=torch.bool) # num_cols x 32000 (or vocab size)
+        if isinstance(vocab_masks, np.ndarray): # 32000 x num_cols
+            vocab_masks = vocab_masks.astype(bool, copy=False).T
+        else: # {'1':32000-list, '2':32000-list, etc}
+            vocab_masks = vocab_masks[:]
+            vocab_masks = np.stack([np.asarray(vocab_masks[c], dtype=bool) for c in vocab_masks], axis=0)
+        self.vocab_masks = torch.from_numpy(vocab_masks).contiguous() # num_cols x 32000 (or vocab size)
         
+        # templates only depend on the prompt and max_column_len, so build them once
+        self._head_inds, self._prompt_template = self._build_templates()
+        # label positions of prompt 0, column 1, prompt 1, ..., column n, prompt n (head_inds is shifted by BOS)
+        slot_heads = torch.cat((torch.zeros(1, dtype=self._head_inds.dtype), self._head_inds))
+        self._prompt_slots = torch.where(slot_heads == 0)[0]
+        self._target_slots = torch.where(slot_heads > 0)[0]
+        self._prompt_flat = torch.cat(self.prompt_ids, dim=0).long()
+        self._label_cols = None # column order of the instances, set on the first labelled batch
+        self._seq_len = slot_heads.shape[0] # every labelled row has the same length, so no padding to mask
+        # generation batches start every row from BOS + first prompt token
+        self._gen_seed = torch.tensor([[self.tokenizer.bos_token_id, self.prompt_ids[0][1].item()]], dtype=torch.long)
         
-    def get_templates(self):
-        # form head_inds
-        col_head_inds = [be.squeeze() for be in torch.split(torch.arange(1,self.num_cols+1).unsqueeze(1).repeat(1,self.max_column_len),1)]
-        head_inds = torch.cat( sum(([ae,be] for ae,be in zip(self.prompt_head_inds, col_head_inds)), []) +  [self.prompt_head_inds[-1]]) 
-        #                                                      intersperse                               ^ since there's 1 more prompt, won't be in zip
+        
+    def _tokenize_prompt(self, prompt):
+        # prompt is fixed per dataset, so its ids are cached on disk and reused by later runs and other ranks
+        key = hashlib.sha1(json.dumps(prompt, sort_keys=True).encode() 
+                           + f'{self.tokenizer.__class__.__name__}{self.tokenizer.name_or_path}{len(self.tokenizer)}'.encode()).hexdigest()
+        cache_path = join(PROMPT_CACHE_DIR, f'prompt_ids_{key}.pt')
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        
+        if distributed and torch.distributed.get_rank() != 0:
+            torch.distributed.barrier() # wait for rank 0 to write the cache
+        if exists(cache_path):
+            prompt_ids = torch.load(cache_path)
+        else:
+            prompt_ids = [torch.as_tensor(chunk) for chunk in self.tokenizer(prompt, add_special_tokens=False)['input_ids']]
+            try:
+                os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+                tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+                torch.save(prompt_ids, tmp_path)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                warnings.warn(f'Could not cache prompt ids to {cache_path}: {e}')
+        if distributed and torch.distributed.get_rank() == 0:
+            torch.distributed.barrier()
+        return prompt_ids
+        
+        
+    def _build_templates(self):
+        # form head_inds: segments prompt 0, column 1, prompt 1, ..., column n, prompt n
+        seg_lens = torch.full((2*self.num_cols+1,), self.max_column_len, dtype=torch.long)
+        seg_lens[0::2] = torch.tensor([len(chunk) for chunk in self.prompt_head_inds])
+        seg_heads = torch.zeros_like(seg_lens) # prompt tokens belong to head 0
+        seg_heads[1::2] = torch.arange(1, self.num_cols+1)
+        head_inds = torch.repeat_interleave(seg_heads, seg_lens)
         
         # for generation
         prompt_template = torch.zeros_like(head_inds, dtype=torch.long)
         prompt_template[torch.where(head_inds==0)] = torch.cat(self.prompt_ids, dim=0)[1:]
-        return head_inds, prompt_template, self.vocab_masks, self.max_column_len
+        return head_inds, prompt_template
+    
+    
+    def get_templates(self):
+        return self._head_inds, self._prompt_template, self.vocab_masks, self.max_column_len
         
     
     def __call__(self, instances: Sequence[Dict]) -> Dict:
         # instances = instances[0]
-        instances= pd.DataFrame(instances)
         # Extract elements
         batch_size = len(instances)
-        if len(instances.columns) > 1: 
-            include_labels = True
-        else:
-            include_labels = False
-        instances = instances.drop('length', axis=1)
+        include_labels = len(instances[0]) > 1 # generation batches only carry 'length'
+        if include_labels and self._label_cols is None:
+            self._label_cols = [c for c in instances[0] if c != 'length']
         
         if include_labels:
+            # row1col1 row1col2 ... row2col1 row2col2 etc
+            flat = [instance[c] for instance in instances for c in self._label_cols] # (num_cols*batch_size,)
             # tokenize column labels
-            targets = self.tokenizer(instances.values.reshape((1,-1))[0].tolist(),  # (num_cols*batch_size,) ndarray row1col1 row1col2 ... row2col1 row2col2 etc
-                                    add_special_tokens=False, padding='max_length', return_tensors='pt', max_length=self.max_column_len, truncation=True)
-            col_tokens_len = targets['input_ids'].shape[-1]
-            # batch_size*num_cols x max_column_len,  pads tokens with 0s
-            # print('targets', targets['input_ids'], targets['input_ids'].shape, self.max_column_len)
+            targets = self.tokenizer(flat, add_special_tokens=False, max_length=self.max_column_len, truncation=True)['input_ids']
+            # batch_size*num_cols x max_column_len, pads tokens with pad_token_id
+            lens = np.fromiter(map(len, targets), dtype=np.int64, count=len(targets))
+            row_idx, col_idx = _ragged_indices(lens)
+            targets_tok = torch.full((len(targets), self.max_column_len), self.tokenizer.pad_token_id, dtype=torch.long)
+            targets_tok[row_idx, col_idx] = torch.from_numpy(np.fromiter(chain.from_iterable(targets), dtype=np.int64, count=int(lens.sum())))
+            # print('targets', targets_tok, targets_tok.shape, self.max_column_len)
             
             # batch_size x num_cols x max_column_len:
-            targets_tok = targets['input_ids'].reshape((batch_size, self.num_cols, self.max_column_len)) 
+            targets_tok = targets_tok.view((batch_size, self.num_cols, self.max_column_len)) 
             # print('targets_tok', targets_tok.shape)
         
             # insert column labels into proper places within cloze prompt
-            labels_list = [] 
-            for i in range(self.num_cols):
-                stretch_chunk = self.prompt_ids[i].repeat(batch_size, 1) # bs x tokens
-                labels_list.extend([stretch_chunk, targets_tok[:,i,:]])
-            stretch_chunk = self.prompt_ids[-1].repeat(batch_size, 1)
-            labels_list.append(stretch_chunk)
-            labels = torch.cat(labels_list, dim=1).long()
+            labels = _assemble_labels(self._prompt_flat, self._prompt_slots, self._target_slots, targets_tok)
             # print(labels[0].shape, self.head_inds.shape,)
             # assert(labels.shape[1]-1 == self.head_inds.shape[0])
             
-            input_ids = copy.deepcopy(labels)
-            attention_mask = torch.ones_like(input_ids) # labels.ne(self.tokenizer.pad_token_id)
+            input_ids = labels.clone()
+            attention_mask = torch.ones((batch_size, self._seq_len), dtype=torch.long) # labels.ne(self.tokenizer.pad_token_id)
             data_dict = {
                 'input_ids': input_ids,
                 'attention_mask': attention_mask,
@@ -616,9 +778,8 @@ class DataCollatorForMHLM:
             }
             
         else: #not include labels
-            input_ids = torch.tile(input=torch.as_tensor((self.tokenizer.bos_token_id, self.prompt_ids[0][1]), dtype=torch.long), 
-                                   dims=(batch_size, 1))
-            attention_mask = torch.ones_like(input_ids)
+            input_ids = self._gen_seed.repeat(batch_size, 1)
+            attention_mask = torch.ones((batch_size, 2), dtype=torch.long)
             data_dict = {
                 'input_ids': input_ids,
                 'attention_mask': attention_mask,
@@ -638,6 +799,7 @@ class DataCollatorForCausalLM(object):
     target_max_len: int
     train_on_source: bool
     predict_with_generate: bool
+    pad_to_multiple_of: int = 8 # training batches are padded to their longest row, rounded up for tensor cores
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
         # Extract elements
@@ -656,50 +818,53 @@ class DataCollatorForCausalLM(object):
             truncation=True,
             add_special_tokens=False,
         )
-        # Build the input and labels for causal LM
-        input_ids = []
-        labels = []
-        for tokenized_source, tokenized_target in zip(
-            tokenized_sources_with_prompt['input_ids'],
-            tokenized_targets['input_ids']
-        ):
-            if not self.predict_with_generate: # always here
-                input_ids.append(torch.tensor(tokenized_source + tokenized_target))
-                if not self.train_on_source: #always here
-                    labels.append(
-                        torch.tensor([IGNORE_INDEX for _ in range(len(tokenized_source))] + copy.deepcopy(tokenized_target))
-                    )
-                else:
-                    labels.append(torch.tensor(copy.deepcopy(tokenized_source + tokenized_target)))
-            else:
-                input_ids.append(torch.tensor(tokenized_source))
-        # Apply padding
-        input_ids = pad_sequence(input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id)
-        labels = pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX) if not self.predict_with_generate else None
+        tokenized_sources = tokenized_sources_with_prompt['input_ids']
+        tokenized_targets = tokenized_targets['input_ids']
+        if self.predict_with_generate:
+            tokenized_targets = [[] for _ in tokenized_sources]
+        # Build the input and labels for causal LM in a single padded block
+        batch_size = len(tokenized_sources)
+        src_lens = np.fromiter(map(len, tokenized_sources), dtype=np.int64, count=batch_size)
+        tgt_lens = np.fromiter(map(len, tokenized_targets), dtype=np.int64, count=batch_size)
+        total = src_lens + tgt_lens
+        max_len = int(total.max())
+        if not self.predict_with_generate: # generation continues from the end of each row, so don't pad past the longest one
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        num_tokens = int(total.sum())
+        # row1 source, row1 target, row2 source, ... flattened into one buffer
+        flat = np.fromiter(
+            chain.from_iterable(chain.from_iterable(zip(tokenized_sources, tokenized_targets))),
+            dtype=np.int64, count=num_tokens
+        )
+        row_idx, col_idx = _ragged_indices(total)
+        flat = torch.from_numpy(flat)
+
+        input_ids = torch.full((batch_size, max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        input_ids[row_idx, col_idx] = flat
+        positions = torch.arange(max_len)
+        attention_mask = positions < torch.from_numpy(total)[:, None]
         data_dict = {
             'input_ids': input_ids,
-            'attention_mask':input_ids.ne(self.tokenizer.pad_token_id),
+            'attention_mask': attention_mask,
         }
-        if labels is not None:
-            data_dict['labels'] = labels
+        if not self.predict_with_generate: # always here
+            if not self.train_on_source: #always here
+                is_label = attention_mask & (positions >= torch.from_numpy(src_lens)[:, None])
+            else:
+                is_label = attention_mask
+            data_dict['labels'] = input_ids.masked_fill(~is_label, IGNORE_INDEX)
         return data_dict
 
 def extract_unnatural_instructions_data(examples, extract_reformulations=False):
-    out = {
-        'input': [],
-        'output': [],
-    }
-    for example_instances in examples['instances']:
-        for instance in example_instances:
-            out['input'].append(instance['instruction_with_input'])
-            out['output'].append(instance['output'])
+    # batched: use with dataset.map(..., batched=True, num_proc=os.cpu_count(), remove_columns=dataset.column_names)
+    instances = [instance for example_instances in examples['instances'] for instance in example_instances]
     if extract_reformulations:
-        for example_reformulations in examples['reformulations']:
-            if example_reformulations is not None:
-                for instance in example_reformulations:
-                    out['input'].append(instance['instruction_with_input'])
-                    out['output'].append(instance['output'])
-    return out
+        instances += [instance for example_reformulations in examples['reformulations'] 
+                      if example_reformulations is not None for instance in example_reformulations]
+    return {
+        'input': [instance['instruction_with_input'] for instance in instances],
+        'output': [instance['output'] for instance in instances],
+    }
 
 ALPACA_PROMPT_DICT = {
     "prompt_input": (
@@ -721,6 +886,13 @@ def extract_alpaca_dataset(example):
         prompt_format = ALPACA_PROMPT_DICT["prompt_no_input"]
     return {'input': prompt_format.format(**example)}
 
+def load_shards(dataset_name):
+    # each split is its own arrow directory; loading is mostly IO wait, so threads overlap the reads
+    shard_files = [f for f in os.listdir(dataset_name) if not f.endswith('.json')]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(shard_files), os.cpu_count() or 1))) as ex:
+        shards = list(ex.map(lambda f: load_from_disk(os.path.join(dataset_name, f)), shard_files))
+    return DatasetDict(dict(zip(shard_files, shards)))
+
 def local_dataset(dataset_name):
     if dataset_name.endswith('.json') or dataset_name.endswith('.jsonl'):
         full_dataset = Dataset.from_json(path_or_paths=dataset_name)
@@ -730,11 +902,7 @@ def local_dataset(dataset_name):
         full_dataset = Dataset.from_pandas(pd.read_csv(dataset_name, delimiter='\t'))
     elif dataset_name.endswith('.dat'):
         if 'dataset_dict.json' in os.listdir(dataset_name):
-            full_dataset = DatasetDict({})
-            for f in os.listdir(dataset_name):
-                if f.endswith('.json'): continue
-                full_dataset[f] = load_from_disk(os.path.join(dataset_name, f))
-            return full_dataset
+            return load_shards(dataset_name)
         else:
             full_dataset = load_from_disk(dataset_name)
     else:
@@ -767,6 +935,15 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
             pass
         return dataset
 
+    def add_length(dataset):
+        # the length-grouped sampler reads a 'length' column; mhlm data ships one, inout data gets character counts
+        if 'length' in dataset.column_names or 'input' not in dataset.column_names:
+            return dataset
+        return dataset.map(
+            lambda batch: {'length': [len(i) + len(o) for i, o in zip(batch['input'], batch['output'])]},
+            batched=True, num_proc=min(os.cpu_count() or 1, 8) if len(dataset) > 100_000 else None,
+        )
+
      # Load dataset.
     dataset = load_data(args.dataset)
     dataset = format_dataset(dataset, args.dataset_format)
@@ -783,14 +960,12 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
             eval_dataset = dataset['test']
         if args.max_eval_samples is not None and args.eval_dataset_size>0 and len(eval_dataset) > args.max_eval_samples:
             eval_dataset = eval_dataset.select(range(args.max_eval_samples))
-        # if args.group_by_length and args.eval_dataset_size>0:
-        #     eval_dataset = eval_dataset.map(lambda x: {'length': sum([len(x[col] for col in x)])})
     if args.do_train or args.do_generate:
         train_dataset = dataset['train']
         if args.do_train and args.max_train_samples is not None and len(train_dataset) > args.max_train_samples:
             train_dataset = train_dataset.select(range(args.max_train_samples))
-        # if args.group_by_length:
-        #     train_dataset = train_dataset.map(lambda x: {'length': len(x['input']) + len(x['output'])})
+        if args.group_by_length:
+            train_dataset = add_length(train_dataset)
 
     if 'prompt' in dataset:
         data_collator = DataCollatorForMHLM(
@@ -811,6 +986,16 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
             train_on_source=args.train_on_source,
             predict_with_generate=args.predict_with_generate,
         )
+    if tokenizer.is_fast: # the prompt pieces and a sample of each column's values, as the collators will tokenize them
+        parity_dataset = dataset['train']
+        if 'prompt' in dataset:
+            parity_texts = data_collator.prompt + [str(v) for c in parity_dataset.column_names if c != 'length' 
+                                                   for v in parity_dataset.unique(c)[:100]]
+        else:
+            parity_rows = parity_dataset.select(range(min(len(parity_dataset), 100)))
+            parity_texts = [f"{tokenizer.bos_token}{x}" for x in parity_rows['input']] \
+                           + [f"{x}{tokenizer.eos_token}" for x in parity_rows['output']]
+        check_tokenizer_parity(tokenizer, parity_texts, args)
     return dict(
         train_dataset=train_dataset if args.do_train or args.do_generate else None,
         eval_dataset=eval_dataset if args.do_eval else None,
@@ -820,35 +1005,97 @@ def make_data_module(tokenizer: transformers.PreTrainedTokenizer, args) -> Dict:
 
 def get_last_checkpoint(checkpoint_dir):
     if isdir(checkpoint_dir):
-        is_completed = exists(join(checkpoint_dir, 'completed'))
+        is_completed = False
         # if is_completed: return None, True # already finished
         max_step = 0
-        for filename in os.listdir(checkpoint_dir):
-            if isdir(join(checkpoint_dir, filename)) and filename.startswith('checkpoint'):
-                max_step = max(max_step, int(filename.replace('checkpoint-', '')))
+        with os.scandir(checkpoint_dir) as entries: # DirEntry caches the file type, so no extra stat per entry
+            for entry in entries:
+                if entry.name == 'completed':
+                    is_completed = True
+                elif entry.name.startswith('checkpoint-') and entry.is_dir():
+                    max_step = max(max_step, int(entry.name[len('checkpoint-'):]))
         if max_step == 0: return None, is_completed # training started, but no checkpoint
         checkpoint_dir = join(checkpoint_dir, f'checkpoint-{max_step}')
         print(f"Found a previous checkpoint at: {checkpoint_dir}")
         return checkpoint_dir, is_completed # checkpoint found!
     return None, False # first training
 
+def tokenize_options(tokenizer, options_strs, max_column_len, device):
+    # token ids of every column's options, L2-normalized once so each batch only needs a dot product.
+    # all columns go through the tokenizer in one call and are split back per column afterwards
+    options = tokenizer(list(chain.from_iterable(o.tolist() for o in options_strs)), add_special_tokens=False, 
+                        padding='max_length', return_tensors='pt', max_length=max_column_len, truncation=True)['input_ids']
+    # float64: digits tokenize to neighbouring ids near 29900, so numeric options differ in cosine only around 1e-10
+    options = options.to(device).double()
+    options = options / options.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+    return list(options.split([len(o) for o in options_strs]))
+
+def match_options(col_toks, options):
+    # index of the most cosine-similar option for each generated row (batch_size x max_column_len).
+    # queries are unit rows in float64 like the options, see tokenize_options
+    query = col_toks.to(options.device).double()
+    query = query / query.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+    if options.device.type == 'cpu' and simsimd is not None:
+        # rows are already unit length; simsimd's cosine kernel approximates rsqrt and can't separate numeric options
+        return np.asarray(simsimd.cdist(query.numpy(), options.numpy(), metric='inner')).argmax(axis=1)
+    if options.device.type == 'cpu' and cos_argmax is not None:
+        return cos_argmax(query.numpy(), options.numpy())
+    # both sides are unit length, so cosine is a dot product; float64 matmuls don't go through allow_tf32
+    return (query @ options.T).argmax(dim=1).cpu().numpy()
+
+def save_to_disk_atomic(dataset, path):
+    # save beside path and swap it in, so an interrupted save never leaves a partial dataset at path
+    tmp_path, old_path = f'{path}.tmp', f'{path}.old'
+    for p in (tmp_path, old_path):
+        if exists(p): shutil.rmtree(p)
+    dataset.save_to_disk(tmp_path)
+    if exists(path): os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if exists(old_path): shutil.rmtree(old_path)
+
+class PredictionWriter:
+    # appends each batch of sampled rows to an arrow stream beside path, so earlier rows are never re-serialized.
+    # writes run on a background thread so the next generate() overlaps them; close() turns the stream into a saved dataset at path
+    def __init__(self, path, features):
+        self.path = path
+        self.stream_path = f'{path}.arrow'
+        os.makedirs(os.path.dirname(self.stream_path) or '.', exist_ok=True)
+        # fixed up front from the real data, so a batch that only matched None can't change the schema
+        self.schema = features.arrow_schema
+        self.writer = pa.ipc.new_stream(self.stream_path, self.schema)
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _write(self, columns):
+        self.writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=self.schema))
+
+    def write(self, columns):
+        if self.pending is not None: self.pending.result() # at most one batch in flight, and write errors surface here
+        self.pending = self.pool.submit(self._write, columns)
+
+    def close(self):
+        if self.pending is not None: self.pending.result()
+        self.pool.shutdown()
+        self.writer.close()
+        save_to_disk_atomic(Dataset.from_file(self.stream_path), self.path)
+        os.remove(self.stream_path)
+
 def sample(args):
     dataname = args.dataset.split('/')[-2]
     modelname = args.output_dir.split('/')[-1]
     path = f'/mnt/data/sonia/datasets/synthetic/{dataname}/{modelname}.dat'
     
-    tokenizer = AutoTokenizer.from_pretrained('/mnt/data/zoo/llama2/llama2-7b-hf/',
-            padding_side="right",
-            use_fast=False, # Fast tokenizer giving issues.
-            )
+    tokenizer = load_tokenizer('/mnt/data/zoo/llama2/llama2-7b-hf/', args) # fast unless --use_slow_tokenizer
     data_module = make_data_module(tokenizer=tokenizer, args=args)
     collator = data_module['data_collator']
-    real = data_module['train_dataset'].to_pandas().drop(['length'], axis=1)
+    # column names and unique values come straight from arrow, no need to pull the whole table into pandas
+    train_dataset = data_module['train_dataset']
+    columns = [c for c in train_dataset.column_names if c != 'length']
+    options_strs = [np.asarray(train_dataset.unique(col)) for col in columns]
     tokenizer = collator.tokenizer
     
     ckpt_path = get_last_checkpoint(args.output_dir)[0]
-    transformers.AutoConfig.register('mhllama', MHLlamaConfig)
-    transformers.AutoModelForCausalLM.register(MHLlamaConfig, MultiheadLlamaForCausalLM)
+    register_mhllama()
     config = MHLlamaConfig(**vars(args))
     print('loading from', ckpt_path)
     model = AutoModelForCausalLM.from_pretrained(
@@ -858,25 +1105,25 @@ def sample(args):
     model = PeftModel.from_pretrained(model, join(ckpt_path, 'adapter_model'), is_trainable=True)
     model = model.merge_and_unload()
     
-    preds = [ [] for _ in range(real.shape[1]) ]
     batch_size = 100
-    num_samples = real.shape[0]
+    num_samples = len(train_dataset)
+    n_batches = math.ceil(num_samples / batch_size)
+    last_batch_size = num_samples - (n_batches-1)*batch_size # only generate the remainder in the last batch
     inputs = collator(batch_size*[{'length': 0}])
+    inputs_last = collator(last_batch_size*[{'length': 0}]) if last_batch_size != batch_size else inputs
+    
+    # options never change between batches, so tokenize them once up front
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    options_by_col = tokenize_options(tokenizer, options_strs, args.generation_config.max_column_len, device)
+    writer = PredictionWriter(path, Features({col: train_dataset.features[col] for col in columns}))
     
     print('beginning generation')
 
-    for batch in tqdm(range(num_samples//batch_size + 1)):
-        _, batch_col_toks = model.generate(**inputs) # batch_size x num_cols x max_column_len
-
-        for i, col in enumerate(real.columns):
-            options_str = real[col].unique()
-            options = tokenizer(options_str.tolist(), add_special_tokens=False, padding='max_length', return_tensors='pt', 
-                                max_length=args.generation_config.max_column_len, truncation=True)['input_ids']
-            preds_col = options_str[cosine_similarity(batch_col_toks[:, i, :], options).argmax(axis=1)]
-            preds[i].extend(preds_col)
-            
-            hp = Dataset.from_pandas(pd.DataFrame(preds).T)
-            hp.save_to_disk(path)
+    for batch in tqdm(range(n_batches)):
+        _, batch_col_toks = model.generate(**(inputs_last if batch == n_batches-1 else inputs)) # batch_size x num_cols x max_column_len
+        writer.write({col: options_strs[i][match_options(batch_col_toks[:, i, :], options_by_col[i])].tolist()
+                      for i, col in enumerate(columns)})
+    writer.close()
 
 
 def train():
@@ -886,6 +1133,18 @@ def train():
     model_args, data_args, training_args, generation_args   , extra_args = \
         hfparser.parse_args_into_dataclasses(return_remaining_strings=True)
     training_args.generation_config = transformers.GenerationConfig(**vars(generation_args))
+    if training_args.dataloader_num_workers > 0:
+        if training_args.dataloader_prefetch_factor is None:
+            training_args.dataloader_prefetch_factor = 4
+    else:
+        training_args.dataloader_persistent_workers = False
+    if training_args.do_mmlu_eval: # persistent workers make the Trainer reuse its cached eval dataloader instead of MMLU's
+        training_args.dataloader_persistent_workers = False
+    if training_args.adam8bit and training_args.bits in (4, 8):
+        if version.parse(importlib.metadata.version('bitsandbytes')) >= version.parse('0.40.0'):
+            training_args.optim = OptimizerNames.PAGED_ADAMW_8BIT # 8-bit states halve what gets paged
+        else:
+            warnings.warn(f'--adam8bit needs bitsandbytes>=0.40.0 for paged 8-bit AdamW, keeping {training_args.optim}')
     args = argparse.Namespace(
         **vars(model_args), **vars(data_args), **vars(training_args)
     )
@@ -949,27 +1208,32 @@ def train():
         #                 loss = outputs["loss"] if isinstance(outputs, dict) else outputs[0]
                         
         #             # Diversity term
+        #             # torchmetrics kernels stay on the logits' device, in bf16 to halve the O(H^2 D) traffic
+        #             heads = outputs.logits.squeeze().to(torch.bfloat16)
         #             if args.divdist == 'manhattan':
-        #                 dist_matrix = manhattan(outputs.logits.squeeze())
+        #                 dist_matrix = manhattan(heads)
         #             elif args.divdist == 'cosine':
-        #                 dist_matrix = cossim(outputs.logits.squeeze())
+        #                 dist_matrix = cossim(heads)
         #             else:
         #                 return ValueError(f'Unsupported diversity distance function {args.divdist}')
-        #             dist_matrix = dist_matrix.to(outputs.logits.get_device()) / args.divc1
-        #             diversity = torch.mean(torch.exp(-dist_matrix)) * args.divc2
+        #             diversity = torch.mean(torch.exp(-dist_matrix.float() / args.divc1)) * args.divc2
+        #             del heads, dist_matrix # free the pairwise matrix before backward
         #             print(diversity)
 
         #             return (loss+diversity, outputs) if return_outputs else loss+diversity
             
         #     trainerclass = CustomSeq2SeqTrainer
         # else: 
-        trainerclass = Seq2SeqTrainer
+        trainerclass = EvalOutputSeq2SeqTrainer
                     
         
         trainer = trainerclass(
             model=model,
             tokenizer=tokenizer,
             args=training_args,
+            # the sample callback only decodes token ids, so gather those instead of N x L x vocab logits
+            preprocess_logits_for_metrics=(lambda logits, labels: logits.argmax(dim=-1)) 
+                if args.eval_samples and not args.predict_with_generate else None,
             **{k:v for k,v in data_module.items() if k != 'predict_dataset'},
         )
 
@@ -979,32 +1243,47 @@ def train():
         if args.report_to == ['wandb']:
             print('adding wandb callback')
             class WandbMetricsCallback(WandbCallback):
+                # losses are buffered on device and their means logged every wandb_log_substeps, not one wandb call per substep
+                def __init__(self):
+                    super().__init__()
+                    self._buffers = {'train': [], 'eval': []}
+                def _buffer(self, split, every):
+                    if self._wandb is None or self._wandb.run is None: return
+                    self._buffers[split].append({k: torch.as_tensor(v).detach() for k, v in model.to_log.items()})
+                    if len(self._buffers[split]) >= every: self._flush(split)
+                def _flush(self, split):
+                    buffer = self._buffers[split]
+                    if not buffer: return
+                    self._wandb.log({k: torch.stack([b[k] for b in buffer if k in b]).float().mean().item() for k in buffer[0]})
+                    buffer.clear()
                 def on_substep_end(self, args, state, control, **kwargs):
-                    self._wandb.log(model.to_log)
+                    self._buffer('train', args.wandb_log_substeps)
                 def on_prediction_step(self, args, state, control, **kwargs):
-                    mets = {k+'_eval':model.to_log[k] for k in model.to_log}
-                    self._wandb.log(model.to_log)
+                    self._buffer('eval', args.wandb_log_substeps)
+                def on_evaluate(self, args, state, control, **kwargs):
+                    self._flush('eval')
+                    return super().on_evaluate(args, state, control, **kwargs)
+                def on_train_end(self, args, state, control, **kwargs):
+                    self._flush('train')
+                    return super().on_train_end(args, state, control, **kwargs)
                     
             trainer.add_callback(WandbMetricsCallback)
         if args.eval_samples:
             class evalSampleCallback(transformers.TrainerCallback):
                 def on_evaluate(self, args, state, control, model, **kwargs):
-                    trainer.model.eval()
-                    metrics = trainer.predict(test_dataset=data_module['eval_dataset'],metric_key_prefix="predict")
+                    metrics = trainer._last_eval_output # the evaluation that triggered this callback already has the predictions
+                    trainer._last_eval_output = None # don't hold them on the trainer until the next evaluation
+                    if metrics is None or metrics.predictions is None:
+                        trainer.model.eval()
+                        metrics = trainer.predict(test_dataset=data_module['eval_dataset'],metric_key_prefix="predict")
                     
-                    predictions = []
-                    for i in range(len(metrics.predictions)):
-                        logit = metrics.predictions[i]
-                        # print('logit', logit)
-                        # print(logit.shape)
-                        label = metrics.label_ids[i] #just to see positions where prompt tokens are at
-                        # print('label', label)
-                        # print(label.shape)
-                        logit_abcd = logit[label != IGNORE_INDEX]
-                        toks = np.argmax(logit_abcd, axis=1)
-                        predictions.append(
-                            ''.join(trainer.tokenizer.decode(toks, skip_special_tokens=True, clean_up_tokenization_spaces=True)) + '\n'
-                            )
+                    # token ids for the whole eval set (already argmaxed by preprocess_logits_for_metrics unless generating),
+                    # then keep each row's label positions (labels just mark where the prompt is)
+                    toks = metrics.predictions if metrics.predictions.ndim == 2 else metrics.predictions.argmax(axis=-1)
+                    keep = metrics.label_ids != IGNORE_INDEX
+                    predictions = [text + '\n' for text in trainer.tokenizer.batch_decode(
+                        [row[mask] for row, mask in zip(toks, keep)], skip_special_tokens=True, clean_up_tokenization_spaces=True
+                    )]
                     
                     with open(os.path.join(args.output_dir, 'samples.txt'), 'a') as f:
                         f.write(f'step {trainer.state.global_step}\n')
@@ -1037,6 +1316,8 @@ def train():
                 tokenizer("C", add_special_tokens=False).input_ids[0],
                 tokenizer("D", add_special_tokens=False).input_ids[0],
             ]
+            abcd_lookup = torch.full((len(tokenizer),), -1, dtype=torch.long) # token id -> answer index
+            abcd_lookup[abcd_idx] = torch.arange(len(abcd_idx))
             accuracy = evaluate.load("accuracy")
             class MMLUEvalCallback(transformers.TrainerCallback):
                 def on_evaluate(self, args, state, control, model, **kwargs):
@@ -1049,12 +1330,15 @@ def train():
                     for batch in tqdm(data_loader, total=len(data_loader)):
                         (loss, logits, labels) = trainer.prediction_step(trainer.model,batch,prediction_loss_only=False,)
                         # There are two tokens, the output, and eos token.
-                        for i, logit in enumerate(logits):
-                            label_non_zero_id = (batch['labels'][i] != -100).nonzero()[0][0]
-                            logit_abcd = logit[label_non_zero_id-1][abcd_idx]
-                            preds.append(torch.argmax(logit_abcd).item())
-                        labels = labels[labels != IGNORE_INDEX].view(-1, 2)[:,0]
-                        refs += [abcd_idx.index(label) for label in labels.tolist()]
+                        # The answer is read off the logits one position before the first label token, for the whole batch at once
+                        is_label = labels != IGNORE_INDEX
+                        first = is_label.float().argmax(dim=1)
+                        rows = torch.arange(logits.size(0), device=logits.device)
+                        refs_batch = abcd_lookup[labels[rows, first].cpu()]
+                        if not is_label.any(dim=1).all() or (refs_batch < 0).any():
+                            raise ValueError('Every MMLU example needs a label whose first token is A, B, C or D')
+                        preds += logits[rows, first-1][:, abcd_idx].argmax(dim=1).tolist()
+                        refs += refs_batch.tolist()
                         loss_mmlu += loss.item()
                     # Extract results by subject.
                     results = {'mmlu_loss':loss_mmlu/len(data_loader)}
@@ -1,3 +1,4 @@
+import math
 import os
 from qlora import *
 import numpy as np
@@ -7,8 +8,7 @@ import torch
 import transformers
 import argparse
 from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
-from datasets import load_dataset, Dataset, load_from_disk
-from sklearn.metrics.pairwise import cosine_similarity
+from datasets import load_dataset, Features
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -34,10 +34,7 @@ path = os.path.join(args.output_dir, 'synth.dat')
 os.makedirs(path, exist_ok=True)
 print('will save to', path)
 
-tokenizer = AutoTokenizer.from_pretrained('/mnt/data/zoo/llama2/llama2-7b-hf/',
-        padding_side="right",
-        use_fast=False, # Fast tokenizer giving issues.
-        )
+tokenizer = load_tokenizer('/mnt/data/zoo/llama2/llama2-7b-hf/', args) # fast unless --use_slow_tokenizer
 data_module = make_data_module(tokenizer=tokenizer, args=args)
 collator = data_module['data_collator']
 print('data loaded')
@@ -49,34 +46,39 @@ model.set_templates(collator.get_templates())
     
 print('loaded model')
 
-full_dataset = DatasetDict({})
-for f in os.listdir(args.dataset):
-    if f.endswith('.json'): continue
-    full_dataset[f] = load_from_disk(os.path.join(args.dataset, f))
-real = full_dataset['train'].to_pandas().drop(['length'], axis=1)
+full_dataset = load_shards(args.dataset)
+train_dataset = full_dataset['train']
 
-preds = [ [] for _ in range(real.shape[1]) ]
 unmatched = []
 batch_size = 50
-num_samples = 5000 # real.shape[0]
-inputs = collator(batch_size*[{'length': 0}])
+num_samples = 5000 # len(train_dataset)
+n_batches = math.ceil(num_samples / batch_size)
+last_batch_size = num_samples - (n_batches-1)*batch_size # only generate the remainder in the last batch
+
+def generation_inputs(n):
+    inputs = collator(n*[{'length': 0}])
+    if torch.cuda.is_available(): # same inputs every batch, so copy them to the model's device once
+        inputs = {c: inputs[c].pin_memory().to(model.device, non_blocking=True) for c in inputs}
+    return inputs
+
+inputs = generation_inputs(batch_size)
+inputs_last = generation_inputs(last_batch_size) if last_batch_size != batch_size else inputs
+
+# each column's options are fixed, so tokenize and L2-normalize them once; matching is then a matmul + argmax
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+columns = [c for c in train_dataset.column_names if c != 'length']
+options_strs = [np.asarray(train_dataset.unique(col)) for col in columns] # arrow unique, no pandas round trip
+options_by_col = tokenize_options(tokenizer, options_strs, args.generation_config.max_column_len, device)
+writer = PredictionWriter(path, Features({col: train_dataset.features[col] for col in columns}))
 
 print('beginning generation')
 
-for batch in tqdm(range(num_samples//batch_size)):
-    _, batch_col_toks = model.generate(**inputs) # batch_size x num_cols x max_column_len
-    unmatched.append(batch_col_toks)
+for batch in tqdm(range(n_batches)):
+    _, batch_col_toks = model.generate(**(inputs_last if batch == n_batches-1 else inputs)) # batch_size x num_cols x max_column_len
+    unmatched.append(batch_col_toks.cpu())
+    writer.write({col: options_strs[i][match_options(batch_col_toks[:, i, :], options_by_col[i])].tolist()
+                  for i, col in enumerate(columns)})
 
-    for i, col in enumerate(real.columns):
-        options_str = real[col].unique()
-        options = tokenizer(options_str.tolist(), add_special_tokens=False, padding='max_length', return_tensors='pt', 
-                            max_length=args.generation_config.max_column_len, truncation=True)['input_ids']
-        preds_col = options_str[cosine_similarity(batch_col_toks[:, i, :], options).argmax(axis=1)]
-        preds[i].extend(preds_col)
-        
-    if batch % 500 == 0:
-        unmatched_np = np.concatenate(unmatched, axis=0)
-        unmatched_np.tofile(os.path.join(path, 'raw_np'))
-        df = pd.DataFrame(preds).T
-        hp = Dataset.from_pandas(df)
-        hp.save_to_disk(path)
+writer.close() # replaces the directory, so raw_np goes in afterwards
+unmatched_np = np.concatenate(unmatched, axis=0)
+unmatched_np.tofile(os.path.join(path, 'raw_np'))